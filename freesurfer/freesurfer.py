@@ -9,6 +9,7 @@ import sys
 import os  # system functions
 import re
 import json
+import csv
 
 #import redcap # from PyCap http://sburns.org/2013/07/10/freesurfer-stats-in-redcap.htm
 #from recon_stats import Subject
@@ -17,14 +18,24 @@ import json
 import argparse
 import _utilities as util
 import subprocess
+import threading
 
+import numpy as np
+import nibabel as nib
 import nipype.interfaces.fsl as fsl
 import nipype.interfaces.freesurfer as fs
 from nipype.pipeline.engine import Workflow, Node
 
 import datetime
 import getpass
+import glob
+import gzip
+import zlib
+import hashlib
+import contextlib
+import fcntl
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 import logging
 
@@ -120,6 +131,54 @@ def iw_subprocess( callCommand, verboseFlag=False, debugFlag=False,  nohupFlag=F
                print(' ')
 
 
+def iw_subprocess_parallel( callCommands, verboseFlag=False, debugFlag=False, logNames=None ):
+     """
+     Run a list of commands concurrently and block until all of them finish.
+
+     Like iw_subprocess with nohupFlag, the commands are started with nohup in their own process group,
+     so they keep running if this process is interrupted or the terminal is closed. Each command writes to
+     nohup.stdout/stderr.<logName>.<timestamp>.log in the current directory, where logNames defaults to
+     the command index. Returns the list of return codes in the order of callCommands.
+     """
+
+     iiDateTime = datetime.datetime.now()
+     timeStamp = iiDateTime.strftime('%Y%m%d%H%M%S')
+
+     if logNames is None:
+          logNames = [str(ii) for ii in range(len(callCommands))]
+
+     pipes = []
+
+     for callCommand, logName in zip(callCommands, logNames):
+
+          callCommand = ['nohup'] + list(map(str, callCommand))
+
+          stdout_log_file = 'nohup.stdout.' + logName + '.' + timeStamp + '.log'
+          stderr_log_file = 'nohup.stderr.' + logName + '.' + timeStamp + '.log'
+
+          if verboseFlag or debugFlag:
+               print('')
+               print(' '.join(callCommand))
+               print(stdout_log_file)
+               print('')
+
+          with open(stdout_log_file, 'w') as stdout_log, open(stderr_log_file, 'w') as stderr_log:
+               pipes.append(subprocess.Popen(callCommand,
+                                             stdout=stdout_log,
+                                             stderr=stderr_log,
+                                             preexec_fn=os.setpgrp,
+                                             ))
+
+     return_codes = [pipe.wait() for pipe in pipes]
+
+     if debugFlag:
+          print(' ')
+          print('Return codes: ' + ', '.join(map(str, return_codes)))
+          print(' ')
+
+     return return_codes
+
+
 def cp_file_with_timestamp(fname, suffix, user=getpass.getuser(), fmt='{fname}.{suffix}.{user}.d%Y%m%d_%H%M%S'):
     return datetime.datetime.now().strftime(fmt).format(fname=fname, suffix=suffix, user=user)
 
@@ -204,6 +263,404 @@ def get_info(in_freesurfer_id, in_freesurfer_subjects_dir=os.getenv('SUBJECTS_DI
 
 #endregion
 
+# ======================================================================================================================
+# region Input Validation
+#
+# Pre-flight checks of the NIfTI and MGH inputs before recon-all is scheduled. Only the headers are parsed.
+# Compressed files (.nii.gz, .mgz) are stream decompressed to the end to confirm the gzip stream is complete
+# and holds the whole volume. Checks are run in a thread pool since they are limited by file system latency.
+#
+# Other formats accepted by recon-all -i (DICOM) are not validated and only reported as such.
+
+PREFLIGHT_MODALITIES = ['t1', 't2', 'flair']
+PREFLIGHT_FORMATS = ['.nii', '.nii.gz', '.mgh', '.mgz']
+PREFLIGHT_MAX_VOXEL_SIZE = {'t1': 1.5, 't2': 2.0, 'flair': 2.0}
+PREFLIGHT_MIN_DIM = 64
+PREFLIGHT_THREADS = 16
+
+
+def preflight_supported(filename):
+
+    return filename.lower().endswith(tuple(PREFLIGHT_FORMATS))
+
+
+def gzip_uncompressed_size(filename, block_size=2**20):
+    """
+    Number of bytes in a gzip file. Raises IOError/EOFError if the gzip stream is truncated or corrupt.
+    """
+
+    size = 0
+
+    with gzip.open(filename, 'rb') as fin:
+        for block in iter(lambda: fin.read(block_size), b''):
+            size += len(block)
+
+    return size
+
+
+def preflight_file(filename, modality='t1'):
+    """
+    Validate the header of a NIfTI or MGH input. Returns a list of errors, empty if the input is valid.
+    """
+
+    if not os.path.isfile(filename):
+        return ['does not exist']
+
+    if not preflight_supported(filename):
+        return []
+
+    try:
+        image = nib.load(filename)
+    except Exception as e:
+        return ['header can not be read (' + str(e) + ')']
+
+    header = image.header
+    errors = []
+
+    # Dimensions
+    shape = image.shape
+
+    if len(shape) < 3 or len(shape) > 4 or (len(shape) == 4 and shape[3] != 1):
+        errors.append('is not a single 3D volume ' + str(shape))
+
+    elif min(shape[:3]) < PREFLIGHT_MIN_DIM:
+        errors.append('dimensions ' + 'x'.join(str(x) for x in shape[:3]) + ' are smaller than ' + str(PREFLIGHT_MIN_DIM))
+
+    # Voxel size
+    zooms = tuple(float(x) for x in header.get_zooms()[:3])
+
+    if min(zooms) <= 0:
+        errors.append('voxel size ' + 'x'.join('%g' % x for x in zooms) + ' is not positive')
+
+    elif max(zooms) > PREFLIGHT_MAX_VOXEL_SIZE.get(modality, PREFLIGHT_MAX_VOXEL_SIZE['t1']):
+        errors.append('voxel size ' + 'x'.join('%g' % x for x in zooms) + ' mm is larger than ' +
+                      str(PREFLIGHT_MAX_VOXEL_SIZE.get(modality, PREFLIGHT_MAX_VOXEL_SIZE['t1'])) + ' mm')
+
+    # Orientation
+    if isinstance(header, nib.Nifti1Header) and header['qform_code'] == 0 and header['sform_code'] == 0:
+        errors.append('has no orientation (qform_code and sform_code are 0)')
+
+    elif isinstance(header, nib.freesurfer.mghformat.MGHHeader) and header['goodRASFlag'] == 0:
+        errors.append('has no orientation (goodRASFlag is 0)')
+
+    else:
+        affine = image.affine[:3, :3]
+
+        if not np.all(np.isfinite(affine)) or abs(np.linalg.det(affine)) < 1e-6:
+            errors.append('orientation matrix is degenerate')
+
+    # Datatype
+    dtype = header.get_data_dtype()
+
+    if dtype.kind not in 'iuf' or dtype.fields is not None:
+        errors.append('datatype ' + str(dtype) + ' is not a real scalar')
+
+    # File size
+    if len(shape) >= 3:
+        expected_size = int(image.dataobj.offset) + int(np.prod(shape)) * dtype.itemsize
+
+        if filename.lower().endswith(('.gz', '.mgz')):
+            try:
+                actual_size = gzip_uncompressed_size(filename)
+            except (IOError, EOFError, zlib.error) as e:
+                errors.append('is truncated or corrupt (' + str(e) + ')')
+                return errors
+        else:
+            actual_size = os.path.getsize(filename)
+
+        if actual_size < expected_size:
+            errors.append('is truncated (' + str(actual_size) + ' of ' + str(expected_size) + ' bytes)')
+
+    return errors
+
+
+def _preflight_file(args):
+    subject_id, modality, filename = args
+    return subject_id, modality, filename, preflight_file(filename, modality)
+
+
+def preflight(manifest, nthreads=PREFLIGHT_THREADS, verbose=False):
+    """
+    Validate all inputs of a manifest, a list of dictionaries with subject_id, t1, t2 and flair.
+
+    Returns a dictionary of {subject_id: [(modality, filename, error), ...]} for the rejected subjects.
+    """
+
+    jobs = [(row['subject_id'], modality, row[modality]) for row in manifest
+            for modality in PREFLIGHT_MODALITIES if row.get(modality)]
+
+    pool = ThreadPool(nthreads)
+
+    try:
+        results = pool.map(_preflight_file, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    rejected = OrderedDict()
+
+    for subject_id, modality, filename, errors in results:
+
+        for error in errors:
+            rejected.setdefault(subject_id, []).append((modality, filename, error))
+            print(subject_id + ', ' + modality + ', ' + filename + ', ' + error)
+
+        if not errors and not preflight_supported(filename):
+            print(subject_id + ', ' + modality + ', ' + filename + ', warning, format is not validated')
+
+        elif verbose and not errors:
+            print(subject_id + ', ' + modality + ', ' + filename + ', ok')
+
+    return rejected
+
+
+def preflight_inputs(fsinfo, verbose=False):
+
+    manifest = [dict(fsinfo['input'], subject_id=fsinfo['base']['subject_id'])]
+
+    return not preflight(manifest, verbose=verbose)
+
+
+def read_manifest(filename):
+
+    with open(filename, 'r') as fin:
+        return [row for row in csv.DictReader(fin)]
+
+
+def write_manifest(filename, manifest):
+
+    with open(filename, 'w') as fout:
+        writer = csv.DictWriter(fout, ['subject_id'] + PREFLIGHT_MODALITIES, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(manifest)
+
+#endregion
+
+# ======================================================================================================================
+# region Result Cache
+#
+# recon-all results are cached by a content hash of the input scans together with the FreeSurfer version
+# and the recon-all flags. The cache index lives in the subjects directory and maps each hash to the first
+# subject that was run with it. When a new subject hashes to a completed entry, the existing subject
+# directory is cloned (copied or hard linked) instead of recomputed. The index is updated under an fcntl lock
+# and replaced atomically since a cohort is usually started as many concurrent invocations.
+#
+# Hard linked clones share file contents with the original subject. cache_unlink_subject() replaces any
+# linked file with a private copy and is called before freeview or recon-all edit a subject.
+
+CACHE_FILE = '.tic_freesurfer_cache.json'
+CACHE_LOCK_FILE = '.tic_freesurfer_cache.lock'
+CACHE_MODES = ['copy', 'link']
+
+
+def hash_file(filename, hasher, block_size=2**20):
+
+    with open(filename, 'rb') as fin:
+        for block in iter(lambda: fin.read(block_size), b''):
+            hasher.update(block)
+
+    return hasher
+
+
+def freesurfer_version():
+
+    build_stamp = os.path.join(os.getenv('FREESURFER_HOME', ''), 'build-stamp.txt')
+
+    if os.path.isfile(build_stamp):
+        with open(build_stamp, 'r') as fin:
+            return fin.read().strip()
+
+    return 'unknown'
+
+
+def cache_key(fsinfo, fs_flags):
+
+    hasher = hashlib.sha1()
+
+    hasher.update(freesurfer_version().encode('utf-8'))
+    hasher.update(' '.join(fs_flags).encode('utf-8'))
+
+    for name, filename in fsinfo['input'].items():
+        if filename:
+            hasher.update(name.encode('utf-8'))
+            hash_file(filename, hasher)
+
+    return hasher.hexdigest()
+
+
+def cache_read(subjects_dir):
+
+    cache_file = os.path.join(subjects_dir, CACHE_FILE)
+
+    if os.path.isfile(cache_file):
+        with open(cache_file, 'r') as fin:
+            return json.load(fin)
+
+    return {'entries': {}, 'hits': []}
+
+
+def cache_write(subjects_dir, cache):
+
+    cache_file = os.path.join(subjects_dir, CACHE_FILE)
+    cache_tmp_file = cache_file + '.' + str(os.getpid())
+
+    with open(cache_tmp_file, 'w') as fout:
+        json.dump(cache, fout, indent=4)
+
+    os.rename(cache_tmp_file, cache_file)
+
+
+@contextlib.contextmanager
+def cache_locked(subjects_dir):
+    """
+    Read the cache index under an exclusive lock and write it back when the block exits.
+    """
+
+    with open(os.path.join(subjects_dir, CACHE_LOCK_FILE), 'a') as lock:
+
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        try:
+            cache = cache_read(subjects_dir)
+            yield cache
+            cache_write(subjects_dir, cache)
+
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def cache_is_running(fsinfo):
+
+    return len(glob.glob(os.path.join(fsinfo['base']['scripts'], 'IsRunning.*'))) > 0
+
+
+def clone_subject(source_dir, target_dir, mode='copy'):
+    """
+    Copy or hard link a subject directory. Symbolic links are recreated and the recon-all
+    scripts/IsRunning.* lock files are not cloned.
+    """
+
+    for root, dirs, files in os.walk(source_dir):
+
+        out_root = os.path.join(target_dir, os.path.relpath(root, source_dir))
+
+        if not os.path.isdir(out_root):
+            os.makedirs(out_root)
+
+        for ii in dirs + files:
+            source_file = os.path.join(root, ii)
+            target_file = os.path.join(out_root, ii)
+
+            if os.path.islink(source_file):
+                os.symlink(os.readlink(source_file), target_file)
+                continue
+
+            if ii in dirs or (os.path.basename(root) == 'scripts' and ii.startswith('IsRunning.')):
+                continue
+
+            if mode == 'link':
+                try:
+                    os.link(source_file, target_file)
+                    continue
+                except OSError:
+                    pass
+
+            shutil.copy2(source_file, target_file)
+
+
+def cache_unlink_subject(fsinfo, verbose=False):
+    """
+    Replace hard linked files of a subject with private copies so edits do not write through to the source.
+    """
+
+    nfiles = 0
+
+    for root, dirs, files in os.walk(fsinfo['base']['subject_dir']):
+        for ii in files:
+            filename = os.path.join(root, ii)
+
+            if os.path.islink(filename) or os.stat(filename).st_nlink < 2:
+                continue
+
+            tmp_filename = filename + '.unlink.' + str(os.getpid())
+            shutil.copy2(filename, tmp_filename)
+            os.rename(tmp_filename, filename)
+
+            nfiles += 1
+
+    if verbose and nfiles:
+        print('Copied ' + str(nfiles) + ' hard linked files in ' + fsinfo['base']['subject_dir'])
+
+    return nfiles
+
+
+def cache_recon_all(fsinfo, fs_flags, mode='copy', verbose=False):
+    """
+    Clone a completed subject with identical inputs, version and flags into this subject's directory.
+
+    Returns True on a cache hit. On a miss the subject is registered in the cache index.
+    """
+
+    subjects_dir = fsinfo['base']['subjects_dir']
+    subject_id = fsinfo['base']['subject_id']
+
+    key = cache_key(fsinfo, fs_flags)
+
+    source_info = None
+
+    with cache_locked(subjects_dir) as cache:
+
+        source_id = cache['entries'].get(key)
+
+        if source_id and source_id != subject_id:
+
+            source_info = get_info(source_id, subjects_dir)
+
+            if cache_is_running(source_info):
+                if verbose:
+                    print('Cache entry ' + source_id + ' is running. Running recon-all.')
+
+                source_info = None
+
+            elif not check_files([source_info['output']['volume']['wmparc']]):
+                if verbose:
+                    print('Cache entry ' + source_id + ' did not complete. Replaced with ' + subject_id + '.')
+
+                cache['entries'][key] = subject_id
+                source_info = None
+
+        else:
+            cache['entries'][key] = subject_id
+
+    if source_info is None:
+        return False
+
+    clone_subject(source_info['base']['subject_dir'], fsinfo['base']['subject_dir'], mode)
+
+    with cache_locked(subjects_dir) as cache:
+        cache['hits'].append(OrderedDict((('subject_id', subject_id),
+                                          ('source_id', source_id),
+                                          ('key', key),
+                                          ('mode', mode),
+                                          ('date', datetime.datetime.now().strftime('%Y%m%d_%H%M%S'))
+                                          )))
+
+    print('Cache hit: ' + subject_id + ' reused from ' + source_id + ' (' + mode + ')')
+
+    return True
+
+
+def status_cache(fsinfo, verbose):
+
+    cache = cache_read(fsinfo['base']['subjects_dir'])
+
+    for hit in cache['hits']:
+        print(hit['subject_id'] + ', ' + hit['source_id'] + ', cache, ' + hit['date'])
+
+    return cache['hits']
+
+#endregion
+
 # ======================================================================================================================
 # region Quality Assurance
 
@@ -211,7 +668,7 @@ def get_info(in_freesurfer_id, in_freesurfer_subjects_dir=os.getenv('SUBJECTS_DI
 def qi(fsinfo, verbose=False):
     input_files = filter(None, fsinfo['input'].values())
 
-    if check_files(input_files):
+    if check_files(input_files) and preflight_inputs(fsinfo, verbose):
 
         qi_command = ['freeview', '-v'] + input_files
 
@@ -228,27 +685,48 @@ def qi(fsinfo, verbose=False):
 
 QA_METHODS = ['mri', 'pial', 'wm_volume', 'wm_surface', 'wm_norm']
 
+# Volumes each QA method displays or copies before editing
+QA_METHODS_VOLUMES = {'mri': ['T1', 'aseg', 'brainmask'],
+                      'pial': ['T1', 'aseg', 'brainmask', 'brain.finalsurfs'],
+                      'wm_volume': ['T1', 'brainmask', 'white_matter'],
+                      'wm_surface': ['T1', 'brainmask', 'white_matter'],
+                      'wm_norm': ['T1', 'brainmask', 'white_matter'],
+                      }
+
+
+def qa_methods_files(selected_qa_method, fsinfo):
+
+    volumes = [x for qm in selected_qa_method if qm in QA_METHODS_VOLUMES for x in QA_METHODS_VOLUMES[qm]]
+
+    return [fsinfo['output']['volume'][x] for x in OrderedDict.fromkeys(volumes)]
+
 def qa_methods(selected_qa_method, fsinfo, verbose=False):
 
     logger = logging.getLogger(__name__)
     logger.debug('qa_methods()')
 
+    # freeview saves edits in place. Make sure they do not write through to a hard linked cache source.
+    if os.path.isdir(fsinfo['base']['subject_dir']) and set(selected_qa_method) & set(QA_METHODS) - {'mri'}:
+        cache_unlink_subject(fsinfo, verbose)
+
+    pipes = []
+
     if 'mri' in selected_qa_method:
-        qa_methods_mri(fsinfo, verbose)
+        pipes.append(qa_methods_mri(fsinfo, verbose))
 
     if 'pial' in selected_qa_method:
-        qa_methods_edit_pial(fsinfo, verbose)
+        pipes.append(qa_methods_edit_pial(fsinfo, verbose))
 
     if 'wm_volume' in selected_qa_method:
-        qa_methods_edit_wm_segmentation(fsinfo, verbose)
+        pipes.append(qa_methods_edit_wm_segmentation(fsinfo, verbose))
 
     if 'wm_surface' in selected_qa_method:
-        qa_methods_edit_wm_surface(fsinfo, verbose)
+        pipes.append(qa_methods_edit_wm_surface(fsinfo, verbose))
 
     if 'wm_norm' in selected_qa_method:
-        qa_methods_edit_wm_norm(fsinfo, verbose)
+        pipes.append(qa_methods_edit_wm_norm(fsinfo, verbose))
 
-    return
+    return pipes
 
 def qa_freesurfer(qm_command, verbose=False):
 
@@ -264,6 +742,8 @@ def qa_freesurfer(qm_command, verbose=False):
     pipe = subprocess.Popen([' '.join(freeview_command)], shell=True,
                             stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL, close_fds=True)
 
+    return pipe
+
 
 def qa_methods_edit_pial(fsinfo, verbose=False):
     # https://surfer.nmr.mgh.harvard.edu/fswiki/FsTutorial/TroubleshootingData
@@ -300,7 +780,7 @@ def qa_methods_edit_pial(fsinfo, verbose=False):
 
     qm_command = ['-v'] + qm_volumes + ['-f'] + qm_surfaces
 
-    qa_freesurfer(qm_command, verbose)
+    return qa_freesurfer(qm_command, verbose)
 
 
 
@@ -329,7 +809,7 @@ def qa_methods_mri(fsinfo, verbose=False):
 
     qm_command = [ '-v' ] + qm_volumes
 
-    qa_freesurfer(qm_command, verbose)
+    return qa_freesurfer(qm_command, verbose)
 
 
 def qa_methods_edit_wm_segmentation(fsinfo, verbose=False):
@@ -360,7 +840,7 @@ def qa_methods_edit_wm_segmentation(fsinfo, verbose=False):
 
     qm_command = [ '-v'] + qm_volumes + ['-f'] + qm_surfaces
 
-    qa_freesurfer(qm_command, verbose)
+    return qa_freesurfer(qm_command, verbose)
 
 def qa_methods_edit_wm_surface(fsinfo, verbose=False):
     # https://surfer.nmr.mgh.harvard.edu/fswiki/FsTutorial/TroubleshootingData
@@ -398,7 +878,7 @@ def qa_methods_edit_wm_surface(fsinfo, verbose=False):
 
     qm_command = ['-v'] + qm_volumes + ['-f'] + qm_surfaces
 
-    qa_freesurfer(qm_command, verbose)
+    return qa_freesurfer(qm_command, verbose)
 
 
 def qa_methods_edit_wm_norm(fsinfo, verbose=False):
@@ -436,39 +916,190 @@ def qa_methods_edit_wm_norm(fsinfo, verbose=False):
 
     qm_command = ['-v'] + qm_volumes + ['-f'] + qm_surfaces
 
-    qa_freesurfer(qm_command, verbose)
+    return qa_freesurfer(qm_command, verbose)
+
+#endregion
+
+# ======================================================================================================================
+# region Quality Assurance Queue
+#
+# Walk a list of subjects for the selected QA methods. freeview is opened for the current subject while the
+# FreeSurfer outputs of the next subjects are read in background threads to warm the page cache, so freeview
+# does not wait on network storage. The reviewer's result for each subject is appended to a CSV file and
+# subjects already reviewed with the same QA methods are skipped.
+
+QA_QUEUE_RESULTS = OrderedDict((('p', 'pass'), ('f', 'fail'), ('s', 'skip')))
+QA_QUEUE_FIELDS = ['subject_id', 'qm', 'result', 'reviewer', 'date']
+
+
+def read_subject_list(filename):
+
+    with open(filename, 'r') as fin:
+        return [x.strip() for x in fin if x.strip() and not x.strip().startswith('#')]
+
+
+def prefetch_files(fileList, block_size=2**20):
+
+    for ii in fileList:
+        try:
+            with open(ii, 'rb') as fin:
+                while fin.read(block_size):
+                    pass
+        except (IOError, OSError):
+            pass
+
+
+def qa_prefetch(fsinfo):
+    """
+    Start a background thread reading all existing FreeSurfer outputs of a subject.
+    """
+
+    fileList = list(fsinfo['output']['volume'].values())
+
+    for hemi in fsinfo['output']['surface'].values():
+        fileList += list(hemi.values())
+
+    fileList = [x for x in OrderedDict.fromkeys(fileList) if os.path.isfile(x)]
+
+    thread = threading.Thread(target=prefetch_files, args=(fileList,))
+    thread.daemon = True
+    thread.start()
+
+    return thread
+
+
+def qa_queue_reviewed(results_file, qm):
+
+    reviewed = set()
+
+    if os.path.isfile(results_file):
+        with open(results_file, 'r') as fin:
+            for row in csv.DictReader(fin):
+                if row['qm'] == qm and row['result'] != 'skip':
+                    reviewed.add(row['subject_id'])
+
+    return reviewed
+
+
+def qa_queue_record(results_file, subject_id, qm, result):
+
+    write_header = not os.path.isfile(results_file)
+
+    with open(results_file, 'a') as fout:
+        writer = csv.writer(fout)
+
+        if write_header:
+            writer.writerow(QA_QUEUE_FIELDS)
+
+        writer.writerow([subject_id, qm, result, getpass.getuser(),
+                         datetime.datetime.now().strftime('%Y%m%d_%H%M%S')])
+
+
+def qa_queue(selected_qa_method, subject_ids, subjects_dir, results_file='qa_queue.csv', prefetch=2, verbose=False):
+
+    selected_qa_method = [x for x in selected_qa_method if x]
+
+    if not selected_qa_method:
+        print('QA queue requires --qm')
+        return
+
+    qm = ' '.join(selected_qa_method)
+
+    reviewed = qa_queue_reviewed(results_file, qm)
+    queue = [get_info(x, subjects_dir) for x in subject_ids if x not in reviewed]
+
+    if verbose:
+        print(str(len(queue)) + ' subjects in queue, ' + str(len(reviewed)) + ' already reviewed')
+
+    prefetch_threads = {}
+
+    for ii, fsinfo in enumerate(queue):
+
+        for jj in range(ii, min(ii + 1 + prefetch, len(queue))):
+            if jj not in prefetch_threads:
+                prefetch_threads[jj] = qa_prefetch(queue[jj])
+
+        subject_id = fsinfo['base']['subject_id']
+
+        print('')
+        print('[' + str(ii + 1) + '/' + str(len(queue)) + '] ' + subject_id)
+
+        # Missing outputs of an unfinished or failed run are recorded as skip so the subject is offered again
+        # in the next session. They are checked before any freeview is opened.
+        try:
+            missing_files = [x for x in qa_methods_files(selected_qa_method, fsinfo) if not os.path.isfile(x)]
+
+            if missing_files:
+                raise IOError('missing ' + ', '.join(missing_files))
+
+            pipes = qa_methods(selected_qa_method, fsinfo, verbose)
+
+        except (IOError, OSError) as e:
+            print(subject_id + ' skipped, ' + str(e))
+            qa_queue_record(results_file, subject_id, qm, QA_QUEUE_RESULTS['s'])
+            continue
+
+        for pipe in pipes:
+            pipe.wait()
+
+        result = None
+
+        while result not in QA_QUEUE_RESULTS and result != 'q':
+            sys.stdout.write(subject_id + ' ' + '/'.join(QA_QUEUE_RESULTS.values()) + '/quit [' +
+                             '/'.join(QA_QUEUE_RESULTS.keys()) + '/q]: ')
+            sys.stdout.flush()
+            line = sys.stdin.readline()
+            result = line.strip().lower()[:1] if line else 'q'
+
+        if result == 'q':
+            break
+
+        qa_queue_record(results_file, subject_id, qm, QA_QUEUE_RESULTS[result])
+
+    return
 
 #endregion
 
 # ======================================================================================================================
 # region Methods
 
-METHODS = ['recon-all', 'pial', 'wm_volume', 'wm_surface', 'wm_norm']
+METHODS = ['recon-all', 'pial', 'wm_volume', 'wm_surface', 'wm_norm', 'longitudinal']
 
 
-def methods(selected_method, fsinfo, verbose=False):
+def methods(selected_method, fsinfo, verbose=False, timepoints=None, cache=None, hemi_parallel=False):
 
     logger.debug('methods()')
 
+    # recon-all reruns edit an existing subject in place. Make sure they do not write through to a hard
+    # linked cache source.
+    if os.path.isdir(fsinfo['base']['subject_dir']) and set(selected_method) & set(METHODS) - {'longitudinal'}:
+        cache_unlink_subject(fsinfo, verbose)
+
+    # Methods that block return False on failure, the others return None
+    status = []
+
     if 'recon-all' in selected_method:
-        methods_recon_all(fsinfo, verbose)
+        status.append(methods_recon_all(fsinfo, verbose, cache))
 
     if 'pial' in selected_method:
-        methods_recon_pial(fsinfo, verbose)
+        status.append(methods_recon_pial(fsinfo, verbose, hemi_parallel))
 
     if 'wm_volume' in selected_method:
-        methods_wm_volume(fsinfo, verbose)
+        status.append(methods_wm_volume(fsinfo, verbose, hemi_parallel))
 
     if 'wm_surface' in selected_method:
-        methods_wm_surface(fsinfo, verbose)
+        status.append(methods_wm_surface(fsinfo, verbose, hemi_parallel))
 
     if 'wm_norm' in selected_method:
-        methods_wm_norm(fsinfo, verbose)
+        status.append(methods_wm_norm(fsinfo, verbose))
 
-    return
+    if 'longitudinal' in selected_method:
+        status.append(methods_longitudinal(fsinfo, timepoints, verbose))
+
+    return False not in status
 
 
-def methods_recon_all(fsinfo, verbose=False):
+def methods_recon_all(fsinfo, verbose=False, cache=None):
     if verbose:
         print('recon_all')
 
@@ -480,6 +1111,10 @@ def methods_recon_all(fsinfo, verbose=False):
 
     if not os.path.isdir(fsinfo['base']['subject_dir']):
 
+        if not preflight_inputs(fsinfo, verbose):
+            print('Input validation failed for ' + fsinfo['base']['subject_id'] + '. recon-all was not run.')
+            return
+
         fs_command += ['-i', fsinfo['input']['t1']]
 
         if fsinfo['input']['t2']:
@@ -488,7 +1123,11 @@ def methods_recon_all(fsinfo, verbose=False):
         if fsinfo['input']['flair']:
             fs_command += ['-FLAIR', fsinfo['input']['flair']]
 
+        if cache:
+            fs_flags = [x for x in fs_command[5:] if x.startswith('-')]
 
+            if cache_recon_all(fsinfo, fs_flags, cache, verbose):
+                return
 
     if verbose:
         print
@@ -499,10 +1138,21 @@ def methods_recon_all(fsinfo, verbose=False):
 
     return
 
-def methods_recon_pial(fsinfo, verbose=False):
+def methods_recon_pial(fsinfo, verbose=False, hemi_parallel=False):
 
     logger.debug('methods_recon_pial()')
 
+    if hemi_parallel:
+
+        if fsinfo['input']['t2'] or fsinfo['input']['flair']:
+            # -T2pial/-FLAIRpial register and normalize the T2/FLAIR volume before refining each pial
+            # surface. Running that volume step from two concurrent -hemi runs is not safe.
+            print('Per hemisphere pial edits are not supported with T2/FLAIR inputs. Running both hemispheres.')
+
+        else:
+            # maskbfs rebuilds brain.finalsurfs.mgz from the manedit volume and is run once before the hemispheres
+            return methods_recon_hemi(fsinfo, ['-autorecon-pial', '-autorecon3'], ['maskbfs'], verbose)
+
     fs_command = [ 'recon-all',
                   '-autorecon-pial', '-autorecon3',
                   '-sd', fsinfo['base']['subjects_dir'],
@@ -525,10 +1175,13 @@ def methods_recon_pial(fsinfo, verbose=False):
 
     return
 
-def methods_wm_volume(fsinfo, verbose=False):
+def methods_wm_volume(fsinfo, verbose=False, hemi_parallel=False):
 
     logger.debug('methods_wm_volume()')
 
+    if hemi_parallel:
+        return methods_recon_hemi(fsinfo, ['-autorecon2-wm', '-autorecon3'], ['fill'], verbose)
+
     fs_command = ['recon-all',
                   '-sd', fsinfo['base']['subjects_dir'],
                   '-subjid', fsinfo['base']['subject_id'],
@@ -545,9 +1198,9 @@ def methods_wm_volume(fsinfo, verbose=False):
 
     return
 
-def methods_wm_surface(fsinfo, verbose=False):
+def methods_wm_surface(fsinfo, verbose=False, hemi_parallel=False):
     logger.debug('methods_wm_surface() direct call to methods_wm_volume()')
-    methods_wm_volume(fsinfo, verbose)
+    return methods_wm_volume(fsinfo, verbose, hemi_parallel)
 
 def methods_wm_norm(fsinfo, verbose=False):
 
@@ -568,6 +1221,181 @@ def methods_wm_norm(fsinfo, verbose=False):
     return
 
 
+# recon-all steps that need both hemispheres. These are skipped in the -hemi runs and run once afterwards.
+RECON_ALL_JOINT_STEPS = ['cortribbon', 'hyporelabel', 'aparc2aseg', 'apas2aseg', 'segstats', 'wmparc']
+
+
+def methods_recon_hemi(fsinfo, fs_flags, pre_steps=None, verbose=False):
+    # Run the recon-all fs_flags for lh and rh concurrently with -hemi. Volume steps listed in pre_steps
+    # are run once before the hemisphere runs, and the RECON_ALL_JOINT_STEPS once after both finish.
+    # Unlike the serial edit methods this call blocks, but the recon-all runs are started with nohup in their
+    # own process group and keep running if it is interrupted.
+
+    logger.debug('methods_recon_hemi()')
+
+    pre_steps = pre_steps if pre_steps else []
+
+    fs_base = ['recon-all',
+               '-sd', fsinfo['base']['subjects_dir'],
+               '-subjid', fsinfo['base']['subject_id'],
+               ]
+
+    no_steps = ['-no' + x for x in pre_steps + RECON_ALL_JOINT_STEPS]
+
+    subject_id = fsinfo['base']['subject_id']
+
+    stages = [('pre', [fs_base + ['-' + x for x in pre_steps]] if pre_steps else []),
+              ('hemi', [fs_base + fs_flags + ['-hemi', hemi] + no_steps for hemi in ['lh', 'rh']]),
+              ('joint', [fs_base + ['-' + x for x in RECON_ALL_JOINT_STEPS]])
+              ]
+
+    log_names = {'pre': [subject_id + '.pre'],
+                 'hemi': [subject_id + '.lh', subject_id + '.rh'],
+                 'joint': [subject_id + '.joint']}
+
+    for stage, stage_commands in stages:
+
+        if not stage_commands:
+            continue
+
+        return_codes = iw_subprocess_parallel(stage_commands, verbose, verbose, log_names[stage])
+
+        if any(return_codes):
+            print('recon-all ' + stage + ' stage failed for ' + fsinfo['base']['subject_id'] + ' (return codes ' +
+                  ', '.join(map(str, return_codes)) + ')')
+            return False
+
+    return True
+
+
+def parse_timepoint(timepoint):
+    """
+    Split a timepoint of the form 'subject_id' or 'subject_id:t1.nii.gz' into (subject_id, t1).
+    """
+
+    tp_id, _, tp_t1 = timepoint.partition(':')
+
+    return tp_id, os.path.abspath(tp_t1) if tp_t1 else None
+
+
+def methods_longitudinal(fsinfo, timepoints, verbose=False):
+    # https://surfer.nmr.mgh.harvard.edu/fswiki/LongitudinalProcessing
+    #
+    # recon-all -all -s <tpNid> -i path_to_tpN_dcm
+    # recon-all -base <templateid> -tp <tp1id> -tp <tp2id> ... -all
+    # recon-all -long <tpNid> <templateid> -all
+    #
+    # The subject_id is used as the base template id. Cross-sectional runs of timepoints
+    # that have not finished are run in parallel, followed by the base and then all
+    # of the -long runs in parallel. Runs with a wmparc.mgz are complete and are not
+    # repeated, so a failed study can be resumed. Unlike the other methods this call blocks.
+
+    logger.debug('methods_longitudinal()')
+
+    if not timepoints:
+        print('Longitudinal method requires --timepoints')
+        return False
+
+    subjects_dir = fsinfo['base']['subjects_dir']
+    base_id = fsinfo['base']['subject_id']
+
+    timepoints = [parse_timepoint(x) for x in timepoints]
+
+    # Validate all timepoint inputs before any stage is scheduled
+    manifest = [{'subject_id': tp_id, 't1': tp_t1} for tp_id, tp_t1 in timepoints if tp_t1]
+
+    if manifest and preflight(manifest, verbose=verbose):
+        print('Input validation failed for ' + base_id + '. Longitudinal runs were not started.')
+        return False
+
+    # Cross-sectional
+    cross_commands = []
+    cross_names = []
+
+    for tp_id, tp_t1 in timepoints:
+
+        tp_info = get_info(tp_id, subjects_dir, tp_t1)
+
+        if check_files([tp_info['output']['volume']['wmparc']]):
+            if verbose:
+                print(tp_id + ' cross-sectional run already complete')
+            continue
+
+        fs_command = ['recon-all',
+                      '-sd', subjects_dir,
+                      '-subjid', tp_id,
+                      '-all',
+                      ]
+
+        if not os.path.isdir(tp_info['base']['subject_dir']):
+
+            if not tp_t1:
+                print('Timepoint ' + tp_id + ' has not been run and requires a T1 (' + tp_id + ':t1.nii.gz)')
+                return False
+
+            fs_command += ['-i', tp_info['input']['t1']]
+
+        cross_commands.append(fs_command)
+        cross_names.append(tp_id)
+
+    # Base template
+    base_commands = []
+
+    if check_files([fsinfo['output']['volume']['wmparc']]):
+        if verbose:
+            print(base_id + ' base run already complete')
+
+    else:
+        base_command = ['recon-all',
+                        '-sd', subjects_dir,
+                        '-base', base_id,
+                        ]
+
+        for tp_id, _ in timepoints:
+            base_command += ['-tp', tp_id]
+
+        base_commands.append(base_command + ['-all'])
+
+    # Longitudinal
+    long_commands = []
+    long_names = []
+
+    for tp_id, _ in timepoints:
+
+        long_info = get_info(tp_id + '.long.' + base_id, subjects_dir)
+
+        if check_files([long_info['output']['volume']['wmparc']]):
+            if verbose:
+                print(long_info['base']['subject_id'] + ' long run already complete')
+            continue
+
+        long_names.append(long_info['base']['subject_id'])
+        long_commands.append(['recon-all',
+                              '-sd', subjects_dir,
+                              '-long', tp_id, base_id,
+                              '-all',
+                              ])
+
+    for stage, stage_commands, stage_names in [('cross-sectional', cross_commands, cross_names),
+                                               ('base', base_commands, [base_id]),
+                                               ('long', long_commands, long_names)]:
+
+        if not stage_commands:
+            continue
+
+        if verbose:
+            print('longitudinal ' + stage)
+
+        return_codes = iw_subprocess_parallel(stage_commands, verbose, verbose, stage_names)
+
+        if any(return_codes):
+            print('Longitudinal ' + stage + ' stage failed for ' + base_id + ' (return codes ' +
+                  ', '.join(map(str, return_codes)) + ')')
+            return False
+
+    return True
+
+
 #endregion
 
 
@@ -638,7 +1466,8 @@ def main():
 
     parser = argparse.ArgumentParser(prog='tic_freesurfer')
 
-    parser.add_argument("subject_id", help="Subject ID", default=os.getcwd())
+    parser.add_argument("subject_id", help="Subject ID (not used with --qm_queue or --preflight)", nargs='?',
+                        default=None)
     parser.add_argument("--subjects_dir", help="Subject's Directory (default=$SUBJECTS_DIR)",
                         default=os.getenv('SUBJECTS_DIR'))
 
@@ -648,13 +1477,31 @@ def main():
     group.add_argument("--t2", help="T2w image NIFTI filename (default=None) ", default=None)
     group.add_argument("--flair", help="T2w FLAIR NIFTI filename (default=None)", default=None)
 
-    parser.add_argument('-m','--methods', help='Methods (recon-all, pial, wm_norm, wm_volume, wm_surface )',
+    parser.add_argument('-m','--methods', help='Methods (recon-all, pial, wm_norm, wm_volume, wm_surface, longitudinal )',
                         nargs=1, choices=METHODS, default=[None])
 
+    parser.add_argument("--hemi_parallel", help="Run pial, wm_volume and wm_surface edits for each hemisphere "
+                                                "concurrently (default=False)", action="store_true", default=False)
+
+    parser.add_argument("--timepoints", help="Longitudinal timepoints as subject_id or subject_id:t1.nii.gz. "
+                                             "The subject_id is used as the base template id (default=None)",
+                        nargs='+', default=None)
+
     parser.add_argument("--qm", help="QA methods (mri, pial, wm_norm, wm_volume, wm_surface)", nargs='*', choices=QA_METHODS, default=[None])
 
-    parser.add_argument("--status", help="Status check. choices=['run', 'results']", nargs='*',
-                        choices=['results', 'run', 'all'], default=[None])
+    parser.add_argument("--qm_queue", help="Review the --qm methods for each subject ID listed in this file (default=None)",
+                        default=None)
+    parser.add_argument("--qm_queue_results", help="QA queue results CSV filename (default=qa_queue.csv)",
+                        default='qa_queue.csv')
+    parser.add_argument("--qm_queue_prefetch", help="Number of subjects to prefetch ahead (default=2)",
+                        type=int, default=2)
+
+    parser.add_argument("--status", help="Status check. choices=['run', 'results', 'cache']", nargs='*',
+                        choices=['results', 'run', 'cache', 'all'], default=[None])
+
+    parser.add_argument("--cache", help="Reuse results of a completed subject with identical inputs by copying "
+                                        "or hard linking its directory (default=None)",
+                        choices=CACHE_MODES, default=None)
 
     FS_LOGS = ['log', 'status']
 
@@ -665,6 +1512,11 @@ def main():
 
     parser.add_argument('-v', '--verbose', help="Verbose flag", action="store_true", default=False)
 
+    parser.add_argument("--preflight", help="Validate the inputs of a CSV manifest with columns subject_id, t1, t2, "
+                                            "flair (default=None)", default=None)
+    parser.add_argument("--preflight_accepted", help="Write the accepted rows of the --preflight manifest to this "
+                                                     "CSV filename (default=None)", default=None)
+
     parser.add_argument('--qi', help="QA inputs", action="store_true", default=False)
     parser.add_argument('--qr', help="QA results", action="store_true", default=False)
 
@@ -672,6 +1524,26 @@ def main():
 
     inArgs = parser.parse_args()
 
+    if inArgs.subject_id is None and not (inArgs.qm_queue or inArgs.preflight):
+        parser.error('subject_id is required')
+
+    # Pre-flight validation
+    if inArgs.preflight:
+        manifest = read_manifest(inArgs.preflight)
+        rejected = preflight(manifest, verbose=inArgs.verbose)
+
+        if inArgs.preflight_accepted:
+            write_manifest(inArgs.preflight_accepted, [x for x in manifest if x['subject_id'] not in rejected])
+
+        print(str(len(manifest) - len(rejected)) + ' of ' + str(len(manifest)) + ' subjects accepted')
+
+        return 1 if rejected else 0
+
+    # QA queue
+    if inArgs.qm_queue:
+        qa_queue(inArgs.qm, read_subject_list(inArgs.qm_queue), inArgs.subjects_dir, inArgs.qm_queue_results,
+                 inArgs.qm_queue_prefetch, inArgs.verbose)
+        return
 
     # Select
 
@@ -684,14 +1556,20 @@ def main():
         qi(fsinfo, inArgs.verbose)
 
 
+    exit_status = 0
+
     # Methods
     if inArgs.methods:
-        methods( inArgs.methods, fsinfo, inArgs.verbose)
+        if not methods( inArgs.methods, fsinfo, inArgs.verbose, inArgs.timepoints, inArgs.cache, inArgs.hemi_parallel):
+            exit_status = 1
 
     # Status
     if 'run' in inArgs.status or 'all' in inArgs.status:
         status_run(fsinfo, True)
 
+    if 'cache' in inArgs.status or 'all' in inArgs.status:
+        status_cache(fsinfo, True)
+
 
     # Upload Results to RedCap
     if inArgs.redcap:
@@ -709,6 +1587,8 @@ def main():
 
         fslogs(inArgs.fslogs, fsinfo, inArgs.verbose)
 
+    return exit_status
+
 
 #endregion
 
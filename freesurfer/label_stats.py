@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+"""
+per label volumes and intensities of a label map (aseg, aparc.a2009s+aseg, wmparc, custom atlases)
+"""
+
+import argparse
+import csv
+import os
+import sys
+
+from collections import OrderedDict
+from multiprocessing import Pool
+
+import numpy as np
+import nibabel as nib
+
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.CRITICAL)
+
+#
+# All labels are computed in a single pass over the label map with np.bincount. The voxel counts,
+# intensity sums and sums of squares are accumulated per label so no per label mask is ever written.
+#
+# Equivalent to running, for every label,
+#
+# tic_labels_remove aseg.nii.gz --out_nii label.nii.gz --keep <label> --bin
+# fslstats norm.nii.gz -k label.nii.gz -V -m -s
+#
+# The mean and std are over all voxels of the label, including zero intensities (-m -s, not -M -S).
+#
+
+STATS_FIELDS = ['subject_id', 'label', 'name', 'voxels', 'volume', 'mean', 'std']
+
+
+def read_color_lut(lut_file=None):
+    """
+    Read a FreeSurfer color look up table into a {label: name} dictionary.
+    """
+
+    if lut_file is None:
+        lut_file = os.path.join(os.getenv('FREESURFER_HOME', ''), 'FreeSurferColorLUT.txt')
+
+    names = {}
+
+    if not os.path.isfile(lut_file):
+        return names
+
+    with open(lut_file, 'r') as fin:
+        for line in fin:
+            fields = line.split()
+
+            if len(fields) >= 2 and fields[0].isdigit():
+                names[int(fields[0])] = fields[1]
+
+    return names
+
+
+def volume_path(subject_dir, volume):
+    """
+    Names without a directory are taken from the subject's mri directory, paths are used as is.
+    """
+
+    if os.sep in volume:
+        return os.path.abspath(volume)
+
+    if not volume.endswith(('.mgz', '.nii', '.nii.gz')):
+        volume += '.mgz'
+
+    return os.path.join(subject_dir, 'mri', volume)
+
+
+def label_stats(label_file, intensity_file=None, keep=None, remove=None):
+    """
+    Voxel counts, volumes (mm^3) and intensity mean/std for every label of label_file.
+
+    Labels in remove are dropped, and when keep is given only those labels are returned.
+    Background (0) is removed unless explicitly kept.
+    """
+
+    label_nii = nib.load(label_file)
+    label_data = np.asarray(label_nii.dataobj).astype(np.int64).ravel()
+
+    if label_data.size and label_data.min() < 0:
+        raise ValueError(label_file + ' contains negative labels')
+
+    voxel_volume = float(np.prod(label_nii.header.get_zooms()[:3]))
+
+    counts = np.bincount(label_data)
+
+    if intensity_file:
+        intensity_nii = nib.load(intensity_file)
+
+        if intensity_nii.shape[:3] != label_nii.shape[:3]:
+            raise ValueError(intensity_file + ' ' + str(intensity_nii.shape) + ' does not match ' +
+                             label_file + ' ' + str(label_nii.shape))
+
+        if not np.allclose(intensity_nii.affine, label_nii.affine, atol=1e-3):
+            raise ValueError(intensity_file + ' and ' + label_file + ' have different voxel to world transforms')
+
+        intensity_data = np.asarray(intensity_nii.dataobj, dtype=np.float64).ravel()
+
+        sums = np.bincount(label_data, weights=intensity_data, minlength=counts.size)
+        sums_squared = np.bincount(label_data, weights=intensity_data * intensity_data, minlength=counts.size)
+
+    labels = np.flatnonzero(counts)
+
+    if keep:
+        labels = labels[np.isin(labels, keep)]
+    else:
+        labels = labels[labels != 0]
+
+    if remove:
+        labels = labels[~np.isin(labels, remove)]
+
+    stats = OrderedDict()
+
+    stats['label'] = labels
+    stats['voxels'] = counts[labels]
+    stats['volume'] = counts[labels] * voxel_volume
+
+    if intensity_file:
+        mean = sums[labels] / counts[labels]
+        variance = np.maximum(sums_squared[labels] / counts[labels] - mean * mean, 0)
+
+        stats['mean'] = mean
+        stats['std'] = np.sqrt(variance)
+
+    return stats
+
+
+def subject_label_stats(subject_id, subjects_dir, labels='aseg', intensity='norm', keep=None, remove=None):
+
+    subject_dir = os.path.join(subjects_dir, subject_id)
+
+    label_file = volume_path(subject_dir, labels)
+    intensity_file = volume_path(subject_dir, intensity) if intensity else None
+
+    return subject_id, label_stats(label_file, intensity_file, keep, remove)
+
+
+def _subject_label_stats(args):
+
+    try:
+        return subject_label_stats(*args) + (None,)
+    except Exception as e:
+        return args[0], None, str(e)
+
+
+def cohort_label_stats(subject_ids, subjects_dir, labels='aseg', intensity='norm', keep=None, remove=None,
+                       nproc=None, verbose=False):
+    """
+    Compute label_stats for each subject in a process pool. Returns a list of (subject_id, stats).
+
+    Subjects that fail are reported and skipped.
+    """
+
+    jobs = [(subject_id, subjects_dir, labels, intensity, keep, remove) for subject_id in subject_ids]
+
+    pool = Pool(nproc)
+
+    try:
+        results = []
+
+        for subject_id, stats, error in pool.imap(_subject_label_stats, jobs):
+
+            if error:
+                print(subject_id + ', skipped, ' + error)
+                continue
+
+            if verbose:
+                print(subject_id + ', ' + str(len(stats['label'])) + ' labels')
+
+            results.append((subject_id, stats))
+
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
+
+
+def write_label_stats(results, out_file, lut=None):
+
+    lut = lut if lut is not None else {}
+
+    with open(out_file, 'w') as fout:
+        writer = csv.writer(fout)
+        writer.writerow(STATS_FIELDS)
+
+        for subject_id, stats in results:
+            for ii, label in enumerate(stats['label']):
+                writer.writerow([subject_id,
+                                 int(label),
+                                 lut.get(int(label), ''),
+                                 int(stats['voxels'][ii]),
+                                 '%.3f' % stats['volume'][ii],
+                                 '%.3f' % stats['mean'][ii] if 'mean' in stats else '',
+                                 '%.3f' % stats['std'][ii] if 'std' in stats else '',
+                                 ])
+
+
+# ======================================================================================================================
+# region Main Function
+#
+
+def main():
+    ## Parsing Arguments
+    #
+    #
+
+    parser = argparse.ArgumentParser(prog='label_stats')
+
+    parser.add_argument("subject_id", help="Subject IDs", nargs='+')
+    parser.add_argument("--subjects_dir", help="Subject's Directory (default=$SUBJECTS_DIR)",
+                        default=os.getenv('SUBJECTS_DIR'))
+
+    parser.add_argument("--labels", help="Label map in the subject's mri directory or a path containing a "
+                                         "directory (default=aseg)", default='aseg')
+    parser.add_argument("--intensity", help="Intensity volume in the subject's mri directory or a path containing a "
+                                            "directory. Use '' for volumes only (default=norm)", default='norm')
+
+    parser.add_argument("--keep", help="Only report these labels (default=all)", nargs='+', type=int, default=None)
+    parser.add_argument("--remove", help="Remove these labels (default=None)", nargs='+', type=int, default=None)
+
+    parser.add_argument("--lut", help="Color look up table (default=$FREESURFER_HOME/FreeSurferColorLUT.txt)",
+                        default=None)
+
+    parser.add_argument("--nproc", help="Number of processes (default=number of CPUs)", type=int, default=None)
+    parser.add_argument("--out", help="Output CSV filename (default=label_stats.csv)", default='label_stats.csv')
+
+    parser.add_argument('-v', '--verbose', help="Verbose flag", action="store_true", default=False)
+
+    inArgs = parser.parse_args()
+
+    results = cohort_label_stats(inArgs.subject_id, inArgs.subjects_dir, inArgs.labels, inArgs.intensity,
+                                 inArgs.keep, inArgs.remove, inArgs.nproc, inArgs.verbose)
+
+    write_label_stats(results, inArgs.out, read_color_lut(inArgs.lut))
+
+
+#endregion
+
+if __name__ == "__main__":
+    sys.exit(main())
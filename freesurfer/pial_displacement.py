@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+"""
+per vertex displacement between the FLAIR/T2 refined pial surface and the pial surface without FLAIR/T2
+"""
+
+import argparse
+import csv
+import os
+import sys
+
+from collections import OrderedDict
+from multiprocessing import Pool
+
+import numpy as np
+import nibabel as nib
+
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.CRITICAL)
+
+#
+# Automated version of the visual check in tic_freesurfer --qm pial
+#
+# freeview -f surf/lh.pial:edgecolor=red surf/lh.woFLAIR.pial:edgecolor=blue
+#
+# Subjects run with -FLAIRpial are compared against ?h.woFLAIR.pial and subjects run with -T2pial
+# against ?h.woT2.pial. Both surfaces share the same vertices, so the displacement is the per vertex
+# distance between them.
+# Regions are taken from an annotation (default aparc) and summarized with np.bincount.
+#
+
+HEMIS = ['lh', 'rh']
+PIAL_REFERENCES = ['woFLAIR', 'woT2']
+
+REGION_FIELDS = ['subject_id', 'hemi', 'region', 'vertices', 'mean', 'max', 'fraction_above', 'flag']
+SUBJECT_FIELDS = ['subject_id', 'hemi', 'reference', 'vertices', 'mean', 'p95', 'max', 'flagged_regions', 'flag']
+
+
+def surface_files(subject_dir, hemi, annot='aparc'):
+
+    surf = os.path.join(subject_dir, 'surf')
+
+    files = OrderedDict((('pial', os.path.join(surf, hemi + '.pial')),
+                         ('reference', None),
+                         ('annot', os.path.join(subject_dir, 'label', hemi + '.' + annot + '.annot'))
+                         ))
+
+    for reference in PIAL_REFERENCES:
+        reference_file = os.path.join(surf, hemi + '.' + reference + '.pial')
+
+        if os.path.isfile(reference_file):
+            files['reference'] = reference_file
+            break
+
+    return files
+
+
+def pial_displacement(pial_file, reference_file):
+    """
+    Euclidean distance (mm) between corresponding vertices of the two pial surfaces.
+    """
+
+    pial = nib.freesurfer.read_geometry(pial_file)[0]
+    reference = nib.freesurfer.read_geometry(reference_file)[0]
+
+    if pial.shape != reference.shape:
+        raise ValueError(pial_file + ' and ' + reference_file + ' have a different number of vertices')
+
+    return np.sqrt(np.sum((pial - reference) ** 2, axis=1))
+
+
+def region_displacement(displacement, annot_file, vertex_threshold=2.0):
+    """
+    Vertex count, mean, max and fraction of vertices above vertex_threshold for each region of annot_file.
+    """
+
+    labels, _, names = nib.freesurfer.read_annot(annot_file)
+
+    if labels.shape[0] != displacement.shape[0]:
+        raise ValueError(annot_file + ' does not match the number of surface vertices')
+
+    # Unassigned vertices (-1) are collected in an extra 'unassigned' bin
+    labels = np.where(labels < 0, len(names), labels)
+    names = [x.decode('utf-8') if isinstance(x, bytes) else x for x in names] + ['unassigned']
+
+    counts = np.bincount(labels, minlength=len(names))
+    sums = np.bincount(labels, weights=displacement, minlength=len(names))
+    above = np.bincount(labels, weights=displacement > vertex_threshold, minlength=len(names))
+
+    maxima = np.zeros(len(names))
+    np.maximum.at(maxima, labels, displacement)
+
+    regions = np.flatnonzero(counts)
+
+    stats = OrderedDict()
+
+    stats['region'] = [names[ii] for ii in regions]
+    stats['vertices'] = counts[regions]
+    stats['mean'] = sums[regions] / counts[regions]
+    stats['max'] = maxima[regions]
+    stats['fraction_above'] = above[regions] / counts[regions]
+
+    return stats
+
+
+def subject_pial_displacement(subject_id, subjects_dir, annot='aparc', vertex_threshold=2.0,
+                              region_threshold=1.0, subject_threshold=0.5):
+    """
+    Displacement summary of both hemispheres. Returns (subject_id, {hemi: (summary, regions)}) or
+    (subject_id, None) if the subject has no woFLAIR/woT2 pial surfaces.
+    """
+
+    subject_dir = os.path.join(subjects_dir, subject_id)
+
+    results = OrderedDict()
+
+    for hemi in HEMIS:
+
+        files = surface_files(subject_dir, hemi, annot)
+
+        if not (os.path.isfile(files['pial']) and files['reference']):
+            return subject_id, None
+
+        displacement = pial_displacement(files['pial'], files['reference'])
+
+        if os.path.isfile(files['annot']):
+            regions = region_displacement(displacement, files['annot'], vertex_threshold)
+            regions['flag'] = regions['mean'] > region_threshold
+        else:
+            regions = None
+
+        summary = OrderedDict()
+
+        summary['reference'] = os.path.basename(files['reference']).split('.')[1]
+        summary['vertices'] = displacement.shape[0]
+        summary['mean'] = float(displacement.mean())
+        summary['p95'] = float(np.percentile(displacement, 95))
+        summary['max'] = float(displacement.max())
+        summary['flagged_regions'] = [x for x, flag in zip(regions['region'], regions['flag']) if flag] if regions else []
+        summary['flag'] = bool(summary['mean'] > subject_threshold or summary['flagged_regions'])
+
+        results[hemi] = (summary, regions)
+
+    return subject_id, results
+
+
+def _subject_pial_displacement(args):
+
+    try:
+        return subject_pial_displacement(*args) + (None,)
+    except Exception as e:
+        return args[0], None, str(e)
+
+
+def cohort_pial_displacement(subject_ids, subjects_dir, annot='aparc', vertex_threshold=2.0, region_threshold=1.0,
+                             subject_threshold=0.5, nproc=None, verbose=False):
+    """
+    Compute subject_pial_displacement for each subject in a process pool. Returns a list of (subject_id, results).
+
+    Subjects without woFLAIR/woT2 pial surfaces or with mismatched surfaces/annotations are reported and skipped.
+    """
+
+    jobs = [(subject_id, subjects_dir, annot, vertex_threshold, region_threshold, subject_threshold)
+            for subject_id in subject_ids]
+
+    pool = Pool(nproc)
+
+    try:
+        results = []
+
+        for subject_id, subject_results, error in pool.imap(_subject_pial_displacement, jobs):
+
+            if error:
+                print(subject_id + ', skipped, ' + error)
+                continue
+
+            if subject_results is None:
+                print(subject_id + ', no woFLAIR/woT2 pial surfaces, skipped')
+                continue
+
+            for hemi, (summary, _) in subject_results.items():
+                if verbose or summary['flag']:
+                    print(subject_id + ', ' + hemi + ', mean=%.3f, max=%.3f, ' % (summary['mean'], summary['max']) +
+                          ('flagged ' + ' '.join(summary['flagged_regions']) if summary['flag'] else 'ok'))
+
+            results.append((subject_id, subject_results))
+
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
+
+
+def write_pial_displacement(results, subjects_file, regions_file=None):
+
+    with open(subjects_file, 'w') as fout:
+        writer = csv.writer(fout)
+        writer.writerow(SUBJECT_FIELDS)
+
+        for subject_id, subject_results in results:
+            for hemi, (summary, _) in subject_results.items():
+                writer.writerow([subject_id, hemi, summary['reference'], summary['vertices'],
+                                 '%.3f' % summary['mean'], '%.3f' % summary['p95'], '%.3f' % summary['max'],
+                                 ' '.join(summary['flagged_regions']), int(summary['flag'])])
+
+    if not regions_file:
+        return
+
+    with open(regions_file, 'w') as fout:
+        writer = csv.writer(fout)
+        writer.writerow(REGION_FIELDS)
+
+        for subject_id, subject_results in results:
+            for hemi, (_, regions) in subject_results.items():
+
+                if regions is None:
+                    continue
+
+                for ii, region in enumerate(regions['region']):
+                    writer.writerow([subject_id, hemi, region, int(regions['vertices'][ii]),
+                                     '%.3f' % regions['mean'][ii], '%.3f' % regions['max'][ii],
+                                     '%.3f' % regions['fraction_above'][ii], int(regions['flag'][ii])])
+
+
+# ======================================================================================================================
+# region Main Function
+#
+
+def main():
+    ## Parsing Arguments
+    #
+    #
+
+    parser = argparse.ArgumentParser(prog='pial_displacement')
+
+    parser.add_argument("subject_id", help="Subject IDs", nargs='+')
+    parser.add_argument("--subjects_dir", help="Subject's Directory (default=$SUBJECTS_DIR)",
+                        default=os.getenv('SUBJECTS_DIR'))
+
+    parser.add_argument("--annot", help="Annotation used for regions (default=aparc)", default='aparc')
+
+    parser.add_argument("--vertex_threshold", help="Vertex displacement (mm) counted in fraction_above (default=2.0)",
+                        type=float, default=2.0)
+    parser.add_argument("--region_threshold", help="Mean region displacement (mm) flagged (default=1.0)",
+                        type=float, default=1.0)
+    parser.add_argument("--subject_threshold", help="Mean hemisphere displacement (mm) flagged (default=0.5)",
+                        type=float, default=0.5)
+
+    parser.add_argument("--nproc", help="Number of processes (default=number of CPUs)", type=int, default=None)
+    parser.add_argument("--out", help="Output subject CSV filename (default=pial_displacement.csv)",
+                        default='pial_displacement.csv')
+    parser.add_argument("--out_regions", help="Output region CSV filename (default=None)", default=None)
+
+    parser.add_argument('-v', '--verbose', help="Verbose flag", action="store_true", default=False)
+
+    inArgs = parser.parse_args()
+
+    results = cohort_pial_displacement(inArgs.subject_id, inArgs.subjects_dir, inArgs.annot, inArgs.vertex_threshold,
+                                       inArgs.region_threshold, inArgs.subject_threshold, inArgs.nproc, inArgs.verbose)
+
+    write_pial_displacement(results, inArgs.out, inArgs.out_regions)
+
+
+#endregion
+
+if __name__ == "__main__":
+    sys.exit(main())